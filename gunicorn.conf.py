@@ -0,0 +1,13 @@
+import os
+
+# gunicorn carrega este arquivo automaticamente: `gunicorn main:app`
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+
+# a API só espera a WBuy (I/O); threads por worker atendem várias requisições
+# em paralelo e poucos workers mantêm o cache em memória aquecido
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+worker_connections = 1000
+keepalive = 30
@@ -1,24 +1,74 @@
+import atexit
+import functools
+import hmac
+import json
 import os
+import re
+import threading
 import time
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import MappingProxyType
 import requests
-from flask import Flask, jsonify, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, g, has_request_context, jsonify, make_response, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # opcional: sem orjson cai no json da stdlib
+    orjson = None
+
 load_dotenv()
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    # jsonify/app.json serializam via orjson (C), bem mais rápido nas listas grandes
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # jsonify: os bytes do orjson vão direto para a resposta, sem o
+        # decode para str e o encode de volta do caminho padrão
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+# JSON de catálogo/pedidos é muito repetitivo: brotli/gzip reduz bastante o tráfego
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 1024
+Compress(app)
+
 API_URL = "https://sistema.sistemawbuy.com.br/api/v1"
 TOKEN = os.getenv("WBUY_TOKEN", "").strip()
+# protege as rotas administrativas (/cache/flush); vazio desativa essas rotas
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
 TIMEOUT = 30
+WBUY_WORKERS = max(1, int(os.getenv("WBUY_WORKERS", "16")))
+WBUY_MAX_IN_FLIGHT = max(WBUY_WORKERS, int(os.getenv("WBUY_MAX_IN_FLIGHT", "32")))
+
+# pool compartilhado para buscar páginas da WBuy em paralelo
+EXECUTOR = ThreadPoolExecutor(max_workers=WBUY_WORKERS, thread_name_prefix="wbuy")
 
 # =========================================================
 # ================= CACHE SIMPLES EM MEMÓRIA ==============
 # =========================================================
 CACHE = {}
+CACHE_LOCK = threading.RLock()
+# as chaves dependem de query params (page_size, status...), então o total é limitado
+CACHE_MAX_ITEMS = 512
 
 def cache_get(key, ttl_sec=600):
     item = CACHE.get(key)
@@ -30,7 +80,91 @@ def cache_get(key, ttl_sec=600):
     return data
 
 def cache_set(key, data):
-    CACHE[key] = (time.time(), data)
+    with CACHE_LOCK:
+        # reinserir move a chave para o fim; as mais antigas saem primeiro
+        CACHE.pop(key, None)
+        CACHE[key] = (time.time(), data)
+        while len(CACHE) > CACHE_MAX_ITEMS:
+            CACHE.pop(next(iter(CACHE)))
+
+
+def cache_clear():
+    with CACHE_LOCK:
+        removed = len(CACHE)
+        CACHE.clear()
+    return removed
+
+
+REFRESHING = set()
+REFRESHING_LOCK = threading.Lock()
+
+
+def refresh_in_background(key, loader):
+    # no máximo um refresh por chave em andamento
+    with REFRESHING_LOCK:
+        if key in REFRESHING:
+            return
+        REFRESHING.add(key)
+
+    def run():
+        try:
+            cache_set(key, loader())
+        except Exception:
+            app.logger.exception("falha ao atualizar cache %s", key)
+        finally:
+            with REFRESHING_LOCK:
+                REFRESHING.discard(key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+INFLIGHT = {}
+INFLIGHT_LOCK = threading.Lock()
+
+
+def load_once(key, loader):
+    # requisições simultâneas para a mesma chave fria esperam uma única carga
+    # em vez de cada uma repetir toda a paginação na WBuy
+    with INFLIGHT_LOCK:
+        fut = INFLIGHT.get(key)
+        owner = fut is None
+        if owner:
+            fut = INFLIGHT[key] = Future()
+
+    if not owner:
+        return fut.result()
+
+    try:
+        data = loader()
+        cache_set(key, data)
+        fut.set_result(data)
+        return data
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with INFLIGHT_LOCK:
+            INFLIGHT.pop(key, None)
+
+
+def cache_get_or_refresh(key, loader, ttl_sec=60, stale_sec=600):
+    # dentro de ttl_sec devolve o cache; até stale_sec devolve o valor antigo
+    # e atualiza em segundo plano; depois disso carrega de forma síncrona
+    item = CACHE.get(key)
+    if item:
+        ts, data = item
+        age = time.time() - ts
+        if age <= ttl_sec:
+            return data
+        if age <= stale_sec:
+            refresh_in_background(key, loader)
+            if has_request_context():
+                # a resposta desta requisição sai com dado antigo: cached_view e
+                # cacheable não devem prolongar a vida dela
+                g.served_stale = True
+            return data
+
+    return load_once(key, loader)
 
 
 # =========================================================
@@ -43,13 +177,118 @@ def safe_error(message, status=500, extra=None):
     return jsonify(payload), status
 
 
+def cacheable(response, max_age=60):
+    # deixa navegador/CDN reaproveitar respostas de catálogo por alguns segundos
+    if g.get("served_stale"):
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    response.headers["Cache-Control"] = f"public, max-age={max_age}"
+    return response
+
+
+def not_modified(etag, headers):
+    # 304 sem corpo quando o If-None-Match bate com o ETag do cache. O
+    # Flask-Compress devolve o ETag com sufixo (":br", ":gzip"), então as
+    # variantes comprimidas também contam; assim nem o corpo nem a compressão
+    # são refeitos
+    inm = request.if_none_match
+    if not inm:
+        return None
+    for tag in (etag, *(f"{etag}:{alg}" for alg in app.config["COMPRESS_ALGORITHM"])):
+        if inm.contains(tag):
+            response = app.response_class(
+                status=304,
+                headers=[(k, v) for k, v in headers if k == "Cache-Control"],
+            )
+            response.set_etag(tag)
+            return response
+    return None
+
+
+def cached_view(ttl_sec=60):
+    # cacheia o corpo (e cabeçalhos) das respostas 200 por path + query string;
+    # CORS e compressão continuam sendo aplicados a cada requisição.
+    # O ETag é calculado uma vez ao cachear: painéis em polling que mandam
+    # If-None-Match recebem 304 sem corpo enquanto o conteúdo não muda
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = ("view", request.full_path)
+            cached = cache_get(key, ttl_sec=ttl_sec)
+            if cached is not None:
+                body, headers, etag = cached
+                return not_modified(etag, headers) or app.response_class(body, headers=headers)
+
+            response = make_response(fn(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed and not g.get("served_stale"):
+                response.add_etag()
+                headers = list(response.headers)
+                etag = response.get_etag()[0]
+                cache_set(key, (response.get_data(), headers, etag))
+                return not_modified(etag, headers) or response
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def json_loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def json_dumps(obj):
+    # bytes compactos, no mesmo formato do app.json
+    if orjson is not None:
+        return orjson.dumps(obj, default=app.json.default)
+    return app.json.dumps(obj).encode()
+
+
+def stream_json_rows(head, rows, chunk_size=500):
+    # devolve {**head, "data": rows} em pedaços, sem montar a string inteira
+    def generate():
+        yield json_dumps(head)[:-1] + b',"data":['
+        for i in range(0, len(rows), chunk_size):
+            if i:
+                yield b","
+            yield json_dumps(rows[i:i + chunk_size])[1:-1]
+        yield b"]}"
+
+    return app.response_class(stream_with_context(generate()), mimetype="application/json")
+
+
+# número no formato brasileiro com vírgula decimal: "7,5", "1.234,56"
+BR_NUM = re.compile(r"\s*(-?\d{1,3}(?:\.\d{3})+|-?\d+),\d*\s*")
+
+
 def to_int(v, default=0):
+    # números já tipados (caso comum no JSON da WBuy) não passam por str/float
+    if type(v) is int:
+        return v
     try:
-        return int(float(str(v).replace(",", ".")))
+        if type(v) is float:
+            return int(v)
+        s = str(v)
+        if "," in s:
+            m = BR_NUM.fullmatch(s)
+            if m:
+                return int(m.group(1).replace(".", ""))
+            s = s.replace(",", ".")
+        return int(float(s))
     except Exception:
         return default
 
 
+def arg_int(name, default=0):
+    # query params chegam como texto; dígitos puros (o caso comum) viram int direto
+    v = request.args.get(name)
+    if v is None:
+        return default
+    if v.isdecimal():
+        return int(v)
+    return to_int(v, default)
+
+
 def wbuy_headers():
     if not TOKEN:
         return None
@@ -60,19 +299,153 @@ def wbuy_headers():
     }
 
 
-def wbuy_get(path, params=None):
+def make_session():
+    # uma única Session reaproveita conexões TCP/TLS (keep-alive) entre chamadas
+    s = requests.Session()
+    # 429/503 ficam fora do Retry: wbuy_get trata esses casos para que o
+    # WbuyLimiter veja o recuo e a espera não segure uma vaga
+    retry = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[500, 502, 504],
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    pool_size = max(50, WBUY_MAX_IN_FLIGHT)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    s.mount("https://", adapter)
+
     headers = wbuy_headers()
-    if headers is None:
+    if headers:
+        s.headers.update(headers)
+    return s
+
+
+SESSION = make_session()
+atexit.register(SESSION.close)
+
+
+class WbuyLimiter:
+    # controle AIMD de chamadas simultâneas à WBuy: +1 vaga a cada janela de
+    # respostas sem erro, metade das vagas em 429/5xx/erro de rede. Falhas de
+    # chamadas iniciadas antes da última redução fazem parte do mesmo pico e
+    # não reduzem de novo (no máximo uma redução por janela)
+    def __init__(self, start, max_limit):
+        self.limit = float(start)
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.ok_streak = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        # devolve o instante de início, que deve ser repassado ao release
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, status, started):
+        with self.cond:
+            self.in_flight -= 1
+            if not status or status == 429 or status >= 500:
+                if started >= self.last_decrease:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = time.monotonic()
+                self.ok_streak = 0
+            else:
+                self.ok_streak += 1
+                if self.ok_streak >= int(self.limit):
+                    self.limit = min(float(self.max_limit), self.limit + 1)
+                    self.ok_streak = 0
+            self.cond.notify_all()
+
+
+WBUY_LIMITER = WbuyLimiter(start=WBUY_WORKERS, max_limit=WBUY_MAX_IN_FLIGHT)
+WBUY_BUSY_RETRIES = 3
+
+
+def retry_after_sec(r, attempt):
+    # usa o Retry-After (em segundos) quando a WBuy informa; senão backoff exponencial
+    v = (r.headers.get("Retry-After") or "").strip()
+    if v.isdecimal():
+        return min(int(v), TIMEOUT)
+    return 0.3 * (2 ** attempt)
+
+
+# validadores (ETag/Last-Modified + JSON da página) ficam fora do CACHE: uma
+# paginação grande não pode expulsar as listagens e views cacheadas
+VALIDATORS = {}
+VALIDATORS_LOCK = threading.Lock()
+VALIDATORS_MAX_ITEMS = max(0, int(os.getenv("WBUY_VALIDATORS_MAX", "256")))
+VALIDATORS_TTL = 3600
+
+
+def validator_get(key):
+    item = VALIDATORS.get(key)
+    if not item:
+        return None
+    ts, data = item
+    if time.time() - ts > VALIDATORS_TTL:
+        return None
+    return data
+
+
+def validator_set(key, data):
+    if not VALIDATORS_MAX_ITEMS:
+        return
+    with VALIDATORS_LOCK:
+        VALIDATORS.pop(key, None)
+        VALIDATORS[key] = (time.time(), data)
+        while len(VALIDATORS) > VALIDATORS_MAX_ITEMS:
+            VALIDATORS.pop(next(iter(VALIDATORS)))
+
+
+def wbuy_get(path, params=None):
+    if not TOKEN:
         raise RuntimeError("WBUY_TOKEN ausente no Environment.")
 
     url = f"{API_URL}{path}"
-    r = requests.get(url, headers=headers, params=params or {}, timeout=TIMEOUT)
+    params = params or {}
+
+    # GET condicional: se a última resposta igual veio com ETag/Last-Modified,
+    # pergunta à WBuy se mudou; em 304 reaproveita o JSON já decodificado
+    etag_key = ("wbuy_etag", path, tuple(params.items() if isinstance(params, dict) else params))
+    validator = validator_get(etag_key)
+    headers = validator[0] if validator else None
+
+    for attempt in range(WBUY_BUSY_RETRIES + 1):
+        status = 0
+        started = WBUY_LIMITER.acquire()
+        try:
+            r = SESSION.get(url, params=params, headers=headers, timeout=TIMEOUT)
+            status = r.status_code
+            # 5xx/erros de conexão já repetidos pelo Retry da Session também
+            # contam como sinal de sobrecarga para o limitador
+            if status < 500 and getattr(getattr(r.raw, "retries", None), "history", None):
+                status = 502
+        finally:
+            WBUY_LIMITER.release(status, started)
+
+        if r.status_code not in (429, 503) or attempt == WBUY_BUSY_RETRIES:
+            break
+        # espera fora do limitador, liberando a vaga para outras chamadas
+        time.sleep(retry_after_sec(r, attempt))
+
+    if r.status_code == 304 and validator:
+        # ainda válido: renova o prazo do validador
+        validator_set(etag_key, validator)
+        return validator[1]
 
     ct = (r.headers.get("content-type") or "").lower()
     if "application/json" not in ct:
         raise RuntimeError(f"WBuy retornou não-JSON ({r.status_code}). Body: {r.text[:300]}")
 
-    data = r.json()
+    if not r.content:
+        raise RuntimeError(f"WBuy retornou corpo vazio ({r.status_code}).")
+
+    data = json_loads(r.content)
 
     rc = str(data.get("responseCode", ""))
     code = str(data.get("code", ""))
@@ -81,41 +454,106 @@ def wbuy_get(path, params=None):
     if rc not in ("200", "201", "") and code not in ("010", "1", ""):
         raise RuntimeError(f"WBuy erro: {data}")
 
+    conditional = {}
+    if r.headers.get("ETag"):
+        conditional["If-None-Match"] = r.headers["ETag"]
+    if r.headers.get("Last-Modified"):
+        conditional["If-Modified-Since"] = r.headers["Last-Modified"]
+    if conditional:
+        validator_set(etag_key, (conditional, data))
+
     return data
 
 
-def get_nested(obj, path, default=""):
-    try:
-        cur = obj
-        for p in path:
-            if not isinstance(cur, dict):
-                return default
-            cur = cur.get(p)
-        return cur if cur is not None else default
-    except Exception:
-        return default
+def iter_wbuy_pages(path, page_size, extract, params=None, max_pages=0, sleep_ms=0):
+    # gera (total, itens) página a página, no formato limit=offset,tamanho.
+    # A primeira página informa o total; as seguintes são buscadas em paralelo
+    # no EXECUTOR e entregues em ordem assim que chegam, então quem consome
+    # processa uma página enquanto as próximas ainda estão em trânsito.
+    # Fechar o gerador cancela as páginas que ainda não começaram.
+    def fetch_page(page_offset):
+        # lista de tuplas: o requests codifica direto, sem converter de dict
+        page_params = [("limit", f"{page_offset},{page_size}")]
+        if params:
+            page_params.extend(params.items())
+        return wbuy_get(path, params=page_params)
+
+    offset = 0
+    total = None
+    pages = 0
+
+    while True:
+        data = fetch_page(offset)
+
+        if total is None:
+            total = to_int(data.get("total", 0), 0)
+
+        items = extract(data)
+        if not items:
+            return
+
+        yield total, items
+
+        offset += page_size
+        pages += 1
+
+        if total and offset >= total:
+            return
+
+        if max_pages and pages >= max_pages:
+            return
+
+        if total and not sleep_ms:
+            offsets = list(range(offset, total, page_size))
+            if max_pages:
+                offsets = offsets[:max_pages - pages]
+
+            for data in EXECUTOR.map(fetch_page, offsets):
+                items = extract(data)
+                if not items:
+                    return
+                yield total, items
+            return
+
+        if sleep_ms and sleep_ms > 0:
+            time.sleep(sleep_ms / 1000.0)
+
+
+# mapeamento vazio compartilhado (somente leitura): evita alocar um {} novo a
+# cada linha quando o objeto aninhado não vem na resposta
+EMPTY = MappingProxyType({})
+
+
+def as_dict(v):
+    # JSON decodificado só produz dict exato; type() evita o isinstance por objeto
+    return v if type(v) is dict else EMPTY
 
 
 # =========================================================
 # ====================== ESTOQUE WBUY =====================
 # =========================================================
+SEM_PRODUTO = "SEM_PRODUTO"
+SEM_TAMANHO = "SEM_TAMANHO"
+SEM_COR = "SEM_COR"
+
+
 def normalize_stock_item(item):
-    produto_obj = item.get("produto") or {}
-    produto_nome = (produto_obj.get("produto") or produto_obj.get("nome") or "SEM_PRODUTO").strip()
+    produto_obj = as_dict(item.get("produto"))
+    produto_nome = (produto_obj.get("produto") or produto_obj.get("nome") or "").strip() or SEM_PRODUTO
 
-    variacao = item.get("variacao") or {}
-    tamanho = (variacao.get("valor") or variacao.get("nome") or "SEM_TAMANHO").strip()
+    variacao = as_dict(item.get("variacao"))
+    tamanho = (variacao.get("valor") or variacao.get("nome") or "").strip() or SEM_TAMANHO
 
-    cor_obj = item.get("cor") or {}
-    cor_nome = (cor_obj.get("nome") or "SEM_COR").strip()
+    cor_obj = as_dict(item.get("cor"))
+    cor_nome = (cor_obj.get("nome") or "").strip() or SEM_COR
 
     qty = to_int(item.get("quantidade_em_estoque"), 0)
 
     return {
         "sku": item.get("sku") or "",
-        "produto": produto_nome or "SEM_PRODUTO",
-        "tamanho": tamanho or "SEM_TAMANHO",
-        "cor": cor_nome or "SEM_COR",
+        "produto": produto_nome,
+        "tamanho": tamanho,
+        "cor": cor_nome,
         "qty": qty,
         "produto_url": item.get("produto_url") or "",
         "ativo": str(item.get("ativo", "")),
@@ -123,39 +561,38 @@ def normalize_stock_item(item):
     }
 
 
-def paginate_stock(page_size=200, sleep_ms=0, only_active=False, only_sale=False):
-    offset = 0
-    total = None
+def fetch_stock_rows(page_size=200, sleep_ms=0):
+    total = 0
     out = []
 
-    while True:
-        data = wbuy_get("/product/stock/", params={"limit": f"{offset},{page_size}"})
-
-        if total is None:
-            total = to_int(data.get("total", 0), 0)
-
-        items = data.get("data") or []
-        if not items:
-            break
-
-        for it in items:
-            row = normalize_stock_item(it)
-
-            if only_active and row["ativo"] != "1":
-                continue
-            if only_sale and row["venda"] != "1":
-                continue
+    for total, items in iter_wbuy_pages(
+        "/product/stock/",
+        page_size,
+        extract=lambda data: data.get("data") or [],
+        sleep_ms=sleep_ms,
+    ):
+        out.extend(map(normalize_stock_item, items))
 
-            out.append(row)
+    return out, total or len(out)
 
-        offset += page_size
-        if total and offset >= total:
-            break
 
-        if sleep_ms and sleep_ms > 0:
-            time.sleep(sleep_ms / 1000.0)
+def paginate_stock(page_size=200, sleep_ms=0, only_active=False, only_sale=False):
+    # a grade completa é compartilhada entre as rotas de estoque; os filtros
+    # são aplicados em memória sobre a mesma leitura
+    rows, total = cache_get_or_refresh(
+        f"stock_rows_ps{page_size}",
+        lambda: fetch_stock_rows(page_size=page_size, sleep_ms=sleep_ms),
+        ttl_sec=60,
+        stale_sec=600,
+    )
+    if not only_active and not only_sale:
+        return list(rows), total
 
-    return out, total or len(out)
+    out = [
+        row for row in rows
+        if (not only_active or row["ativo"] == "1") and (not only_sale or row["venda"] == "1")
+    ]
+    return out, total
 
 
 # =========================================================
@@ -176,47 +613,58 @@ def extract_order_list(data):
     return []
 
 
-def paginate_orders(page_size=100, sleep_ms=0, status_filter=None, max_pages=20):
-    offset = 0
-    total = None
-    out = []
-    pages = 0
-
-    while True:
-        params = {"limit": f"{offset},{page_size}"}
-        if status_filter:
-            params["status"] = status_filter
+def fetch_orders(page_size=100, sleep_ms=0, status_filter=None, max_pages=20):
+    total = 0
+    # paginação por offset numa lista que muda (pedidos novos entrando) pode
+    # repetir um pedido em duas páginas; o dict mantém só a primeira ocorrência
+    out = {}
+
+    for total, items in iter_wbuy_pages(
+        "/order/",
+        page_size,
+        params={"status": status_filter} if status_filter else None,
+        extract=extract_order_list,
+        max_pages=max_pages,
+        sleep_ms=sleep_ms,
+    ):
+        for it in items:
+            pid = (it.get("id") or it.get("pedido_id")) if type(it) is dict else None
+            out.setdefault(str(pid) if pid else id(it), it)
 
-        data = wbuy_get("/order/", params=params)
+    return list(out.values()), total or len(out)
 
-        if total is None:
-            total = to_int(data.get("total", 0), 0)
 
-        items = extract_order_list(data)
-        if not items:
-            break
+def orders_cache_key(page_size, max_pages, status_filter):
+    return f"orders_ps{page_size}_mp{max_pages}_st{status_filter or ''}"
 
-        out.extend(items)
 
-        offset += page_size
-        pages += 1
+def cached_orders(page_size=100, status_filter=None, max_pages=20):
+    # listagem já carregada (e ainda fresca) por paginate_orders, ou None
+    return cache_get(orders_cache_key(page_size, max_pages, status_filter), ttl_sec=30)
 
-        if total and offset >= total:
-            break
 
-        if max_pages and pages >= max_pages:
-            break
+def paginate_orders(page_size=100, sleep_ms=0, status_filter=None, max_pages=20):
+    # listagens repetidas em sequência (painel fazendo polling) saem do cache
+    cached = cached_orders(page_size, status_filter, max_pages)
+    if cached is not None:
+        return cached
 
-        if sleep_ms and sleep_ms > 0:
-            time.sleep(sleep_ms / 1000.0)
+    cache_key = orders_cache_key(page_size, max_pages, status_filter)
 
-    return out, total or len(out)
+    return load_once(
+        cache_key,
+        lambda: fetch_orders(page_size, sleep_ms, status_filter, max_pages),
+    )
 
 
 def normalize_order_item(item):
-    cliente_obj = item.get("cliente") or item.get("customer") or {}
-    endereco_obj = item.get("endereco_entrega") or item.get("shipping_address") or {}
-    frete_obj = item.get("frete") or {}
+    # objetos aninhados desembrulhados uma vez; os campos abaixo são lidos
+    # direto deles em vez de percorrer o caminho a partir da raiz
+    cliente = as_dict(item.get("cliente"))
+    customer = as_dict(item.get("customer"))
+    cliente_obj = as_dict(item.get("cliente") or item.get("customer"))
+    endereco_obj = as_dict(item.get("endereco_entrega") or item.get("shipping_address"))
+    frete_obj = as_dict(item.get("frete"))
 
     pedido_id = (
         item.get("pedido_id")
@@ -236,8 +684,8 @@ def normalize_order_item(item):
     )
 
     cliente_nome = (
-        get_nested(item, ["cliente", "nome"], "")
-        or get_nested(item, ["customer", "name"], "")
+        cliente.get("nome")
+        or customer.get("name")
         or item.get("cliente")
         or item.get("customer_name")
         or ""
@@ -304,31 +752,31 @@ def normalize_order_item(item):
     )
 
     cpf_cnpj = (
-        get_nested(item, ["cliente", "cpf_cnpj"], "")
-        or get_nested(item, ["cliente", "cpf"], "")
-        or get_nested(item, ["cliente", "doc1"], "")
-        or get_nested(item, ["customer", "document"], "")
+        cliente.get("cpf_cnpj")
+        or cliente.get("cpf")
+        or cliente.get("doc1")
+        or customer.get("document")
         or ""
     )
 
     email = (
-        get_nested(item, ["cliente", "email"], "")
-        or get_nested(item, ["customer", "email"], "")
+        cliente.get("email")
+        or customer.get("email")
         or ""
     )
 
     telefone = (
-        get_nested(item, ["cliente", "telefone"], "")
-        or get_nested(item, ["cliente", "celular"], "")
-        or get_nested(item, ["cliente", "fone"], "")
-        or get_nested(item, ["customer", "phone"], "")
+        cliente.get("telefone")
+        or cliente.get("celular")
+        or cliente.get("fone")
+        or customer.get("phone")
         or ""
     )
 
     cidade = (
         endereco_obj.get("cidade")
         or endereco_obj.get("city")
-        or get_nested(cliente_obj, ["cidade"], "")
+        or cliente_obj.get("cidade")
         or ""
     )
 
@@ -336,7 +784,7 @@ def normalize_order_item(item):
         endereco_obj.get("estado")
         or endereco_obj.get("uf")
         or endereco_obj.get("state")
-        or get_nested(cliente_obj, ["estado"], "")
+        or cliente_obj.get("estado")
         or ""
     )
 
@@ -362,7 +810,7 @@ def normalize_order_item(item):
 
 
 def contains_jt_shipping(item, normalized_row=None):
-    frete = item.get("frete") or {}
+    frete = as_dict(item.get("frete"))
     row = normalized_row or normalize_order_item(item)
 
     nome = (frete.get("nome") or row.get("forma_envio") or "").lower()
@@ -394,6 +842,14 @@ def health():
     return jsonify({"ok": True, "token_loaded": bool(TOKEN)})
 
 
+@app.post("/cache/flush")
+def cache_flush():
+    sent = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(sent.encode(), ADMIN_TOKEN.encode()):
+        return safe_error("Não autorizado.", 403)
+    return jsonify({"ok": True, "removidos": cache_clear()})
+
+
 @app.get("/")
 def home():
     return jsonify({
@@ -403,13 +859,14 @@ def home():
 
 
 @app.get("/wbuy/estoque-grade")
+@cached_view(ttl_sec=60)
 def estoque_grade():
     try:
         sizes_param = (request.args.get("sizes") or "").strip()
         expected_sizes = [s.strip() for s in sizes_param.split(",") if s.strip()]
 
-        min_qty = to_int(request.args.get("min_qty", 0), 0)
-        page_size = to_int(request.args.get("page_size", 200), 200)
+        min_qty = arg_int("min_qty", 0)
+        page_size = arg_int("page_size", 200)
 
         only_active = request.args.get("only_active", "1") in ("1", "true", "True")
         only_sale = request.args.get("only_sale", "1") in ("1", "true", "True")
@@ -450,7 +907,7 @@ def estoque_grade():
 
             out.append({"produto": prod_obj["produto"], "cores": cores_list})
 
-        return jsonify({"ok": True, "total_estoques_api": total, "data": out})
+        return cacheable(jsonify({"ok": True, "total_estoques_api": total, "data": out}))
 
     except Exception as e:
         return safe_error(str(e), 500, {"trace": traceback.format_exc()})
@@ -459,9 +916,9 @@ def estoque_grade():
 @app.get("/wbuy/skus")
 def wbuy_skus():
     try:
-        page_size = to_int(request.args.get("page_size", 200), 200)
+        page_size = arg_int("page_size", 200)
         rows, total = paginate_stock(page_size=page_size, only_active=False, only_sale=False)
-        return jsonify({"ok": True, "total": total, "data": rows})
+        return cacheable(stream_json_rows({"ok": True, "total": total}, rows))
     except Exception as e:
         return safe_error(str(e), 500, {"trace": traceback.format_exc()})
 
@@ -469,18 +926,10 @@ def wbuy_skus():
 @app.get("/wbuy/skus/ativos")
 def wbuy_skus_ativos():
     try:
-        page_size = to_int(request.args.get("page_size", 200), 200)
-
-        cache_key = f"skus_ativos_ps{page_size}"
-        cached = cache_get(cache_key, ttl_sec=600)
-        if cached:
-            return jsonify(cached)
+        page_size = arg_int("page_size", 200)
 
         rows, total = paginate_stock(page_size=page_size, only_active=True, only_sale=True)
-
-        payload = {"ok": True, "total": total, "data": rows}
-        cache_set(cache_key, payload)
-        return jsonify(payload)
+        return cacheable(stream_json_rows({"ok": True, "total": total}, rows))
 
     except Exception as e:
         return safe_error(str(e), 500, {"trace": traceback.format_exc()})
@@ -489,18 +938,14 @@ def wbuy_skus_ativos():
 @app.get("/wbuy/skus/ativos-fast")
 def wbuy_skus_ativos_fast():
     try:
-        page_size = to_int(request.args.get("page_size", 200), 200)
+        page_size = arg_int("page_size", 200)
         data = wbuy_get("/product/stock/", params={"limit": f"0,{page_size}"})
         items = data.get("data") or []
 
-        out = []
-        for it in items:
-            row = normalize_stock_item(it)
-            if row["ativo"] != "1":
-                continue
-            if row["venda"] != "1":
-                continue
-            out.append(row)
+        out = [
+            row for row in map(normalize_stock_item, items)
+            if row["ativo"] == "1" and row["venda"] == "1"
+        ]
 
         return jsonify({"ok": True, "total": len(out), "data": out})
 
@@ -513,10 +958,11 @@ def wbuy_skus_ativos_fast():
 # =========================================================
 
 @app.get("/wbuy/pedidos/formas-envio")
+@cached_view(ttl_sec=30)
 def wbuy_pedidos_formas_envio():
     try:
-        page_size = to_int(request.args.get("page_size", 100), 100)
-        max_pages = to_int(request.args.get("max_pages", 20), 20)
+        page_size = arg_int("page_size", 100)
+        max_pages = arg_int("max_pages", 20)
         status_param = (request.args.get("status") or "").strip().lower()
 
         raw_items, total_api = paginate_orders(
@@ -566,17 +1012,13 @@ def wbuy_pedidos_formas_envio():
 
 
 @app.get("/wbuy/pedidos/jt")
+@cached_view(ttl_sec=180)
 def wbuy_pedidos_jt():
     try:
-        page_size = to_int(request.args.get("page_size", 100), 100)
-        max_pages = to_int(request.args.get("max_pages", 20), 20)
+        page_size = arg_int("page_size", 100)
+        max_pages = arg_int("max_pages", 20)
         status_param = (request.args.get("status") or "nota fiscal emitida").strip().lower()
 
-        cache_key = f"pedidos_jt_ps{page_size}_mp{max_pages}_st{status_param}"
-        cached = cache_get(cache_key, ttl_sec=180)
-        if cached:
-            return jsonify(cached)
-
         raw_items, total_api = paginate_orders(
             page_size=page_size,
             sleep_ms=0,
@@ -607,7 +1049,6 @@ def wbuy_pedidos_jt():
             "data": out
         }
 
-        cache_set(cache_key, payload)
         return jsonify(payload)
 
     except Exception as e:
@@ -617,10 +1058,10 @@ def wbuy_pedidos_jt():
 @app.get("/wbuy/pedidos/jt-fast")
 def wbuy_pedidos_jt_fast():
     try:
-        page_size = to_int(request.args.get("page_size", 100), 100)
+        page_size = arg_int("page_size", 100)
         status_param = (request.args.get("status") or "nota fiscal emitida").strip().lower()
 
-        data = wbuy_get("/order/", params={"limit": f"0,{page_size}"})
+        data = wbuy_get("/order/", params={"limit": f"0,{page_size}", "status": status_param})
         items = extract_order_list(data)
 
         out = []
@@ -649,6 +1090,61 @@ def wbuy_pedidos_jt_fast():
         return safe_error(str(e), 500, {"trace": traceback.format_exc()})
 
 
+@app.get("/wbuy/pedidos/rastreio")
+def wbuy_pedidos_rastreio():
+    try:
+        codigos = {
+            c.strip().upper()
+            for c in (request.args.get("codigos") or "").split(",")
+            if c.strip()
+        }
+        if not codigos:
+            return safe_error("Informe ?codigos=COD1,COD2,...", 400)
+
+        page_size = arg_int("page_size", 100)
+        max_pages = arg_int("max_pages", 20)
+        status_param = (request.args.get("status") or "").strip().lower()
+
+        # uma única passada pelos pedidos resolve todos os códigos: usa a
+        # listagem em cache quando paginate_orders já a carregou; senão pagina
+        # a WBuy e para assim que o último código é encontrado
+        pendentes = set(codigos)
+        encontrados = {}
+
+        cached = cached_orders(page_size, status_param, max_pages)
+        if cached is not None:
+            pages = [(cached[1], cached[0])]
+        else:
+            pages = iter_wbuy_pages(
+                "/order/",
+                page_size,
+                params={"status": status_param} if status_param else None,
+                extract=extract_order_list,
+                max_pages=max_pages,
+            )
+
+        for _total, items in pages:
+            for it in items:
+                row = normalize_order_item(it)
+                codigo = row["codigo_rastreio"].strip().upper()
+                if codigo in pendentes:
+                    encontrados[codigo] = row
+                    pendentes.discard(codigo)
+
+            if not pendentes:
+                break
+
+        return jsonify({
+            "ok": True,
+            "total": len(encontrados),
+            "data": encontrados,
+            "nao_encontrados": sorted(pendentes)
+        })
+
+    except Exception as e:
+        return safe_error(str(e), 500, {"trace": traceback.format_exc()})
+
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "10000"))
     app.run(host="0.0.0.0", port=port, debug=False)